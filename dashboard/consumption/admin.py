@@ -5,6 +5,24 @@ from django.contrib import admin
 
 from consumption.models import Consumption, User
 
+
+class ConsumptionAdmin(admin.ModelAdmin):
+    """消費量は閲覧のみとする
+
+    消費量の変更には DailyTotal の再集計とデータのバージョンの更新が必要なため、
+    import コマンドでのみ更新する
+    """
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
 # Register your models here.
 admin.site.register(User)
-admin.site.register(Consumption)
+admin.site.register(Consumption, ConsumptionAdmin)
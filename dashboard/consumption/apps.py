@@ -6,3 +6,7 @@ from django.apps import AppConfig
 
 class ConsumptionConfig(AppConfig):
     name = 'consumption'
+
+    def ready(self):
+        # シグナルのレシーバーを登録
+        from consumption import signals  # noqa: F401
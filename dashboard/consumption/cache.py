@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.cache import cache
+
+from consumption.models import User
+
+# ユーザーIDの一覧のキャッシュキーと有効期限 (秒)
+# NOTE: CACHES を設定していないため、キャッシュはプロセスごとの LocMemCache となる.
+#       import コマンドは別プロセスで動き、Web サーバーのキャッシュは破棄できないため、
+#       インポート後も最大で USER_IDS_CACHE_TIMEOUT 秒の間は古い一覧が表示される
+USER_IDS_CACHE_KEY = 'consumption:user_ids:v1'
+USER_IDS_CACHE_TIMEOUT = 60
+
+
+def get_user_ids() -> list[int]:
+    """全ユーザーのIDを昇順で取得. ページを開くたびに DB を引かないようキャッシュする"""
+    user_ids = cache.get(USER_IDS_CACHE_KEY)
+    if user_ids is None:
+        user_ids = list(User.objects.values_list('id', flat=True).order_by('id'))
+        cache.set(USER_IDS_CACHE_KEY, user_ids, USER_IDS_CACHE_TIMEOUT)
+    return user_ids
+
+
+def clear_user_ids():
+    """このプロセスのユーザーIDの一覧のキャッシュを破棄
+
+    NOTE: bulk_create / bulk_update ではシグナルが送られず、このキャッシュは破棄されない
+    """
+    cache.delete(USER_IDS_CACHE_KEY)
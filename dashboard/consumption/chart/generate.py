@@ -1,19 +1,26 @@
-import base64
 import io
+from datetime import datetime
+from functools import lru_cache
+from typing import Optional
 
+import matplotlib
 import matplotlib.pyplot as plt
 import pandas as pd
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.figure import Figure
 
 from consumption.chart.statistics import (
-    get_area_daily_percentiles,
-    get_area_daily_total_consumptions,
+    get_area_daily_totals_and_percentiles,
     get_daily_percentiles_for_all,
     get_daily_total_consumptions_for_all,
+    get_data_version,
     get_user_area_daily_consumption_median,
     get_user_daily_total_consumptions,
 )
 
+# サーバー上で PNG を生成するだけなので、GUI を伴わない Agg バックエンドを使う
+matplotlib.use('Agg')
+
 
 def plot_total_consumption(df: pd.DataFrame, percentiles: pd.DataFrame) -> Figure:
     fig, ax1 = plt.subplots(figsize=(10, 5))
@@ -53,35 +60,36 @@ def plot_area_consumption(area_totals: pd.DataFrame, area_percentiles: pd.DataFr
     fig, ax = plt.subplots(figsize=(10, 5))
 
     colors = ['red', 'cyan', 'green', 'blue']
-    color_index = 0
+    ax.set_prop_cycle(color=colors)
     ax2 = ax.twinx()
-    for area in area_totals['area'].unique():
-        area_data_totals = area_totals[area_totals['area'] == area]
-        area_data_percentiles = area_percentiles[area_percentiles['area'] == area]
-
-        ax.plot(
-            area_data_totals['date'],
-            area_data_totals['daily_total'],
-            label=f'{area} Total Consumption',
-            color=colors[color_index],
-        )
+    ax2.set_prop_cycle(color=colors)
+
+    # エリアを列に持つ横長の形式に変換し、全エリアの線を1回の plot でまとめて描画
+    totals = area_totals.pivot(index='date', columns='area', values='daily_total')
+    ax.plot(
+        totals.index,
+        totals.to_numpy(),
+        label=[f'{area} Total Consumption' for area in totals.columns],
+    )
+
+    # fill_between は複数系列をまとめて描画できないため、エリアごとに描画
+    for i, (area, area_data_percentiles) in enumerate(area_percentiles.groupby('area')):
         ax2.fill_between(
             area_data_percentiles['date'],
             area_data_percentiles['p10'],
             area_data_percentiles['p90'],
             alpha=0.1,
             label=f'{area} 10-90 Percentile',
-            color=colors[color_index],
-        )
-        ax2.plot(
-            area_data_percentiles['date'],
-            area_data_percentiles['p50'],
-            linestyle='--',
-            label=f'{area} Median',
-            color=colors[color_index],
+            color=colors[i % len(colors)],
         )
 
-        color_index = (color_index + 1) % len(colors)
+    medians = area_percentiles.pivot(index='date', columns='area', values='p50')
+    ax2.plot(
+        medians.index,
+        medians.to_numpy(),
+        linestyle='--',
+        label=[f'{area} Median' for area in medians.columns],
+    )
 
     ax.set_title('Daily Consumption with 10-90 Percentile and Median by Area')
     ax.set_xlabel('Date')
@@ -118,46 +126,64 @@ def plot_user_and_area_consumption(
     return fig
 
 
-def generate_daily_total_consumption_graph() -> str:
-    """日ごとの消費量の総量と、中央値と 10-90%-ile をプロットしたグラフを生成"""
+def render_png(fig: Figure) -> bytes:
+    """Figure を PNG として描画したバイト列を返す
+
+    描画後は Figure を閉じて、pyplot が保持しているメモリを解放する
+    """
+    try:
+        with io.BytesIO() as buffer:
+            FigureCanvasAgg(fig).print_png(buffer)
+            return buffer.getvalue()
+    finally:
+        plt.close(fig)
+
+
+@lru_cache(maxsize=1)
+def _generate_daily_total_consumption_graph(version: Optional[datetime]) -> bytes:
+    """`generate_daily_total_consumption_graph` の結果をデータのバージョンごとにキャッシュ"""
     df = get_daily_total_consumptions_for_all()
     percentiles = get_daily_percentiles_for_all()
 
-    with io.BytesIO() as buffer:
-        fig = plot_total_consumption(df, percentiles)
-        fig.savefig(buffer, format='png')
-        buffer.seek(0)
-        image_png = buffer.getvalue()
+    fig = plot_total_consumption(df, percentiles)
+    return render_png(fig)
 
-    graph = base64.b64encode(image_png).decode('utf-8')
-    return graph
 
+def generate_daily_total_consumption_graph() -> bytes:
+    """日ごとの消費量の総量と、中央値と 10-90%-ile をプロットしたグラフを PNG として生成"""
+    return _generate_daily_total_consumption_graph(get_data_version())
 
-def generate_daily_total_consumption_graph_by_area() -> str:
-    """エリア別に、日ごとの消費量の総量と、中央値と 10-90%-ile をプロットしたグラフを生成"""
-    df = get_area_daily_total_consumptions()
-    percentiles = get_area_daily_percentiles()
 
-    with io.BytesIO() as buffer:
-        fig = plot_area_consumption(df, percentiles)
-        fig.savefig(buffer, format='png')
-        buffer.seek(0)
-        image_png = buffer.getvalue()
+@lru_cache(maxsize=1)
+def _generate_daily_total_consumption_graph_by_area(version: Optional[datetime]) -> bytes:
+    """`generate_daily_total_consumption_graph_by_area` の結果をデータのバージョンごとにキャッシュ"""
+    area_df = get_area_daily_totals_and_percentiles()
+    df = area_df[['area', 'date', 'daily_total']]
+    percentiles = area_df[['area', 'date', 'p10', 'p50', 'p90']]
 
-    graph = base64.b64encode(image_png).decode('utf-8')
-    return graph
+    fig = plot_area_consumption(df, percentiles)
+    return render_png(fig)
 
 
-def generate_user_consumption_graph(user_id: int) -> str:
-    """ユーザーごとの日ごとの消費量の総量と、エリアの中央値をプロットしたグラフを生成"""
+def generate_daily_total_consumption_graph_by_area() -> bytes:
+    """エリア別に、日ごとの消費量の総量と、中央値と 10-90%-ile をプロットしたグラフを PNG として生成"""
+    return _generate_daily_total_consumption_graph_by_area(get_data_version())
+
+
+@lru_cache(maxsize=64)
+def _generate_user_consumption_graph(version: Optional[datetime], user_id: int) -> bytes:
+    """`generate_user_consumption_graph` の結果をデータのバージョンとユーザーごとにキャッシュ
+
+    エリアの中央値はユーザーの所属エリアに依存するが、ユーザー情報のインポートでも
+    データのバージョンは更新されるため、エリアの変更後に古いグラフは返さない
+    """
     user_df = get_user_daily_total_consumptions(user_id)
     area_df = get_user_area_daily_consumption_median(user_id)
 
-    with io.BytesIO() as buffer:
-        fig = plot_user_and_area_consumption(user_df, area_df, user_id)
-        fig.savefig(buffer, format='png')
-        buffer.seek(0)
-        image_png1 = buffer.getvalue()
+    fig = plot_user_and_area_consumption(user_df, area_df, user_id)
+    return render_png(fig)
+
 
-    graph = base64.b64encode(image_png1).decode('utf-8')
-    return graph
+def generate_user_consumption_graph(user_id: int) -> bytes:
+    """ユーザーごとの日ごとの消費量の総量と、エリアの中央値をプロットしたグラフを PNG として生成"""
+    return _generate_user_consumption_graph(get_data_version(), user_id)
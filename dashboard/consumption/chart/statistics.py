@@ -1,9 +1,80 @@
+from datetime import datetime
+from functools import lru_cache
+from typing import Optional
+
 import pandas as pd
+from django.conf import settings
 from django.db import connection
 from django.db.models import Sum
-from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from consumption.models import Consumption, DailyTotal, DataVersion, User
+
+# DataVersion テーブルの唯一の行の ID
+DATA_VERSION_ID = 1
+
 
-from consumption.models import Consumption, User
+def get_data_version() -> Optional[datetime]:
+    """データのバージョンとして、最後にインポートした日時を取得
+
+    ユーザー情報と消費量はインポート時にしか変わらないため、この値が変わらない限り
+    集計結果も変わらないとみなし、キャッシュのキーとして用いる。
+    値は DB に保存されるため、複数のプロセスで同じ値を参照できる。
+
+    Returns
+    -------
+    datetime or None
+        最後にインポートした日時. 一度もインポートしていない場合は None
+    """
+    return (
+        DataVersion.objects.filter(id=DATA_VERSION_ID)
+        .values_list('imported_at', flat=True)
+        .first()
+    )
+
+
+def bump_data_version() -> None:
+    """データのバージョンを更新し、全プロセスの集計結果のキャッシュを無効にする
+
+    インポートと同じトランザクション内で呼び出し、データと同時にコミットされるようにする
+    """
+    DataVersion.objects.update_or_create(
+        id=DATA_VERSION_ID, defaults={'imported_at': timezone.now()}
+    )
+
+
+def refresh_daily_totals() -> None:
+    """Consumption をユーザーごと、日ごとに集計して DailyTotal テーブルに反映
+
+    各集計は 30 分ごとの消費量ではなく、この日ごとの合計 (48 分の 1 のレコード数) を参照する。
+    DB のセッションのタイムゾーン (UTC) ではなく、settings.TIME_ZONE での日付で集計する。
+    """
+    # モデルからテーブル名を取得
+    consumption_table = Consumption._meta.db_table
+    daily_total_table = DailyTotal._meta.db_table
+
+    query = f"""
+    INSERT INTO {daily_total_table} (user_id, date, total)
+    SELECT
+        user_id,
+        (datetime AT TIME ZONE %s)::date AS date,
+        SUM(consumption) AS total
+    FROM {consumption_table}
+    GROUP BY user_id, date
+    ON CONFLICT (user_id, date) DO UPDATE SET total = EXCLUDED.total;
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, [settings.TIME_ZONE])
+
+
+@lru_cache(maxsize=1)
+def _get_daily_total_consumptions_for_all(version: Optional[datetime]) -> pd.DataFrame:
+    """`get_daily_total_consumptions_for_all` の集計結果をデータのバージョンごとにキャッシュ"""
+    daily_total_consumption = (
+        DailyTotal.objects.values('date').annotate(daily_total=Sum('total')).order_by('date')
+    )
+    return pd.DataFrame(daily_total_consumption)
 
 
 def get_daily_total_consumptions_for_all() -> pd.DataFrame:
@@ -16,13 +87,31 @@ def get_daily_total_consumptions_for_all() -> pd.DataFrame:
             date: 日付,
             daily_total: 全ユーザーの日ごとの消費量の合計
     """
-    daily_total_consumption = (
-        Consumption.objects.annotate(date=TruncDate('datetime'))
-        .values('date')
-        .annotate(daily_total=Sum('consumption'))
-        .order_by('date')
-    )
-    return pd.DataFrame(daily_total_consumption)
+    return _get_daily_total_consumptions_for_all(get_data_version()).copy()
+
+
+@lru_cache(maxsize=1)
+def _get_daily_percentiles_for_all(version: Optional[datetime]) -> pd.DataFrame:
+    """`get_daily_percentiles_for_all` の集計結果をデータのバージョンごとにキャッシュ"""
+    # モデルからテーブル名を取得
+    daily_total_table = DailyTotal._meta.db_table
+
+    query = f"""
+    SELECT
+        date,
+        PERCENTILE_CONT(0.1) WITHIN GROUP (ORDER BY total) AS p10,
+        PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY total) AS p50,
+        PERCENTILE_CONT(0.9) WITHIN GROUP (ORDER BY total) AS p90
+    FROM {daily_total_table}
+    GROUP BY date
+    ORDER BY date;
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        rows = cursor.fetchall()
+
+    return pd.DataFrame(rows, columns=['date', 'p10', 'p50', 'p90'])
 
 
 def get_daily_percentiles_for_all() -> pd.DataFrame:
@@ -37,39 +126,61 @@ def get_daily_percentiles_for_all() -> pd.DataFrame:
             p50: 全ユーザーの日ごとの消費量の 50%-ile (median),
             p90: 全ユーザーの日ごとの消費量の 90%-ile
     """
+    return _get_daily_percentiles_for_all(get_data_version()).copy()
+
+
+@lru_cache(maxsize=1)
+def _get_area_daily_totals_and_percentiles(version: Optional[datetime]) -> pd.DataFrame:
+    """`get_area_daily_totals_and_percentiles` の集計結果をデータのバージョンごとにキャッシュ"""
     # モデルからテーブル名を取得
-    consumption_table = Consumption._meta.db_table
+    daily_total_table = DailyTotal._meta.db_table
+    user_table = User._meta.db_table
 
-    # NOTE:
+    # NOTE: ユーザーごとの日ごとの合計をエリア内で足し合わせればエリアの合計になるため、
+    #       合計と %-ile を同じ GROUP BY で計算し、テーブルの走査を1回で済ませる
     query = f"""
-    WITH daily_totals AS (
-        SELECT
-            user_id,
-            DATE_TRUNC('day', datetime) AS date,
-            SUM(consumption) AS daily_total
-        FROM {consumption_table}
-        GROUP BY user_id, date
-    )
     SELECT
+        area,
         date,
-        PERCENTILE_CONT(0.1) WITHIN GROUP (ORDER BY daily_total) AS p10,
-        PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY daily_total) AS p50,
-        PERCENTILE_CONT(0.9) WITHIN GROUP (ORDER BY daily_total) AS p90
-    FROM daily_totals
-    GROUP BY date
-    ORDER BY date;
+        SUM(total) AS daily_total,
+        PERCENTILE_CONT(0.1) WITHIN GROUP (ORDER BY total) AS p10,
+        PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY total) AS p50,
+        PERCENTILE_CONT(0.9) WITHIN GROUP (ORDER BY total) AS p90
+    FROM {daily_total_table} AS d
+    INNER JOIN {user_table} AS u ON d.user_id = u.id
+    GROUP BY area, date
+    ORDER BY area, date;
     """
 
     with connection.cursor() as cursor:
         cursor.execute(query)
         rows = cursor.fetchall()
 
-    return pd.DataFrame(rows, columns=['date', 'p10', 'p50', 'p90'])
+    return pd.DataFrame(rows, columns=['area', 'date', 'daily_total', 'p10', 'p50', 'p90'])
+
+
+def get_area_daily_totals_and_percentiles() -> pd.DataFrame:
+    """エリア別に日ごとの消費量の合計と 10-90%-ile, 中央値を1回のクエリで集計
+
+    Returns
+    -------
+    pandas.DataFrame
+        columns=['area', 'date', 'daily_total', 'p10', 'p50', 'p90']
+            area: エリア名,
+            date: 日付,
+            daily_total: エリア内の全ユーザーの日ごとの消費量の合計,
+            p10: 全ユーザーの日ごとの消費量の 10%-ile,
+            p50: 全ユーザーの日ごとの消費量の 50%-ile (median),
+            p90: 全ユーザーの日ごとの消費量の 90%-ile
+    """
+    return _get_area_daily_totals_and_percentiles(get_data_version()).copy()
 
 
 def get_area_daily_total_consumptions() -> pd.DataFrame:
     """エリア別に日ごとの消費量の合計を集計
 
+    `get_area_daily_totals_and_percentiles` の結果から合計の列を取り出す
+
     Returns
     -------
     pandas.DataFrame
@@ -78,21 +189,14 @@ def get_area_daily_total_consumptions() -> pd.DataFrame:
             date: 日付,
             daily_total: 全ユーザーの日ごとの消費量の合計
     """
-    area_daily_totals = (
-        Consumption.objects.select_related('user')
-        .annotate(date=TruncDate('datetime'))
-        .values('user__area', 'date')
-        .annotate(daily_total=Sum('consumption'))
-        .order_by('user__area', 'date')
-    )
-    df = pd.DataFrame(area_daily_totals)
-    df.rename(columns={'user__area': 'area'}, inplace=True)
-    return df
+    return get_area_daily_totals_and_percentiles()[['area', 'date', 'daily_total']]
 
 
 def get_area_daily_percentiles() -> pd.DataFrame:
     """エリア別に日ごとの消費量の 10-90%-ile と中央値を集計
 
+    `get_area_daily_totals_and_percentiles` の結果から %-ile の列を取り出す
+
     Returns
     -------
     pandas.DataFrame
@@ -103,36 +207,7 @@ def get_area_daily_percentiles() -> pd.DataFrame:
             p50: 全ユーザーの日ごとの消費量の 50%-ile (median),
             p90: 全ユーザーの日ごとの消費量の 90%-ile
     """
-    # モデルからテーブル名を取得
-    consumption_table = Consumption._meta.db_table
-    user_table = User._meta.db_table
-
-    query = f"""
-    WITH daily_totals AS (
-        SELECT
-            area,
-            DATE_TRUNC('day', datetime) AS date,
-            SUM(consumption) AS daily_total
-        FROM {consumption_table} AS c
-        INNER JOIN {user_table} AS u ON c.user_id = u.id
-        GROUP BY area, user_id, date
-    )
-    SELECT
-        area,
-        date,
-        PERCENTILE_CONT(0.1) WITHIN GROUP (ORDER BY daily_total) AS p10,
-        PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY daily_total) AS p50,
-        PERCENTILE_CONT(0.9) WITHIN GROUP (ORDER BY daily_total) AS p90
-    FROM daily_totals
-    GROUP BY area, date
-    ORDER BY area, date;
-    """
-
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        rows = cursor.fetchall()
-
-    return pd.DataFrame(rows, columns=['area', 'date', 'p10', 'p50', 'p90'])
+    return get_area_daily_totals_and_percentiles()[['area', 'date', 'p10', 'p50', 'p90']]
 
 
 def get_user_daily_total_consumptions(user_id: int) -> pd.DataFrame:
@@ -151,10 +226,9 @@ def get_user_daily_total_consumptions(user_id: int) -> pd.DataFrame:
             daily_total: ユーザーの日ごとの消費量の合計
     """
     user_daily_totals = (
-        Consumption.objects.filter(user_id=user_id)
-        .annotate(date=TruncDate('datetime'))
+        DailyTotal.objects.filter(user_id=user_id)
         .values('date')
-        .annotate(daily_total=Sum('consumption'))
+        .annotate(daily_total=Sum('total'))
         .order_by('date')
     )
     return pd.DataFrame(user_daily_totals)
@@ -176,23 +250,16 @@ def get_user_area_daily_consumption_median(user_id: int) -> pd.DataFrame:
             p50: 全ユーザーの日ごとの消費量の 50%-ile (median)
     """
     # モデルからテーブル名を取得
-    consumption_table = Consumption._meta.db_table
+    daily_total_table = DailyTotal._meta.db_table
     user_table = User._meta.db_table
 
     query = f"""
-    WITH daily_totals AS (
-        SELECT
-            DATE_TRUNC('day', datetime) AS date,
-            SUM(consumption) AS daily_total
-        FROM {consumption_table} AS c
-        INNER JOIN {user_table} AS u ON c.user_id = u.id
-        WHERE u.area = (SELECT area FROM {user_table} WHERE id = %s)
-        GROUP BY user_id, date
-    )
     SELECT
         date,
-        PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY daily_total) AS p50
-    FROM daily_totals
+        PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY total) AS p50
+    FROM {daily_total_table} AS d
+    INNER JOIN {user_table} AS u ON d.user_id = u.id
+    WHERE u.area = (SELECT area FROM {user_table} WHERE id = %s)
     GROUP BY date
     ORDER BY date;
     """
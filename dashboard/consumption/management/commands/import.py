@@ -1,13 +1,16 @@
+import io
+import re
 from pathlib import Path
-from typing import Any, Iterable
+from typing import Iterable
 
+import numpy as np
 import pandas as pd
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import transaction
-from django.utils.timezone import make_aware
-from pandas.api.types import is_float_dtype
+from django.db import connection, transaction
+from django.utils import timezone
 
+from consumption.chart.statistics import bump_data_version, refresh_daily_totals
 from consumption.models import Consumption, User
 
 
@@ -15,18 +18,25 @@ def make_user_list_to_create_and_update(
     df: pd.DataFrame, existing_users: dict[int, User]
 ) -> Iterable[list[User]]:
     """User テーブルに登録するユーザーリストと、更新するユーザーリストを作成"""
-    users_to_create = []
-    users_to_update = []
+    ids = df['id'].to_numpy()
+    areas = df['area'].to_numpy()
+    tariffs = df['tariff'].to_numpy()
+
+    # 既存ユーザーかどうかを一括で判定
+    existing_mask = np.isin(ids, list(existing_users))
+
+    users_to_create = [
+        User(id=user_id, area=area, tariff=tariff)
+        for user_id, area, tariff, exists in zip(ids, areas, tariffs, existing_mask)
+        if not exists
+    ]
 
-    for _, row in df.iterrows():
-        user_id = row['id']
-        if user_id in existing_users:
-            user = existing_users[user_id]
-            user.area = row['area']
-            user.tariff = row['tariff']
-            users_to_update.append(user)
-        else:
-            users_to_create.append(User(id=row['id'], area=row['area'], tariff=row['tariff']))
+    users_to_update = []
+    for index in np.flatnonzero(existing_mask):
+        user = existing_users[ids[index]]
+        user.area = areas[index]
+        user.tariff = tariffs[index]
+        users_to_update.append(user)
 
     return users_to_create, users_to_update
 
@@ -39,23 +49,50 @@ def import_user_data(csv_file_path, batch_size=1000):
     if not all(column in df.columns for column in ['id', 'area', 'tariff']):
         raise ValueError("CSV file must contain 'id', 'area', and 'tariff' columns")
 
+    # エリアと関税は取りうる値が少ないため、カテゴリ型にしてメモリを抑える
+    df[['area', 'tariff']] = df[['area', 'tariff']].astype('category')
+
     existing_users = User.objects.in_bulk(df['id'].tolist())
     users_to_create, users_to_update = make_user_list_to_create_and_update(df, existing_users)
 
     with transaction.atomic():
-        for i in range(len(users_to_create) // batch_size + 1):
-            # IndexError が発生しないように処理をスキップ
-            if i * batch_size == len(users_to_create):
-                continue
-            User.objects.bulk_create(users_to_create[i * batch_size : (i + 1) * batch_size])
-
-        for i in range(len(users_to_update) // batch_size + 1):
-            # IndexError が発生しないように処理をスキップ
-            if i * batch_size == len(users_to_update):
-                continue
-            User.objects.bulk_update(
-                users_to_update[i * batch_size : (i + 1) * batch_size], ['area', 'tariff']
-            )
+        User.objects.bulk_create(users_to_create, batch_size=batch_size)
+        User.objects.bulk_update(users_to_update, ['area', 'tariff'], batch_size=batch_size)
+        # エリアの変更はエリア別の集計結果を変えるため、データのバージョンを更新
+        bump_data_version()
+
+
+# 消費量の CSV の列の型. 読み込み時に指定してファイルごとの型推論を省略する
+# NOTE: datetime は pyarrow の CSV パーサーがタイムスタンプとして直接パースするため指定しない
+CONSUMPTION_DTYPES = {'consumption': 'float64'}
+
+# 消費量の CSV のファイル名 (拡張子を除く) として許可するユーザーIDの形式
+USER_ID_PATTERN = re.compile(r'\d+')
+
+
+def read_consumption_csv(file: Path) -> pd.DataFrame:
+    """1ユーザー分の消費量の CSV を読み込み、ファイル名から得たユーザーIDを付与
+
+    ファイル名が数値であることは呼び出し元でチェック済みとする
+    """
+    try:
+        df = pd.read_csv(file, engine='pyarrow', dtype=CONSUMPTION_DTYPES)
+    except ValueError as e:
+        raise ValueError(
+            f'{e}. Correct the aforementioned characters in the consumption CSV ({file}) to the appropriate numerical values.'
+        )
+
+    # 列名のチェック
+    required_columns = {'datetime', 'consumption'}
+    if not required_columns.issubset(df.columns):
+        raise ValueError(f'CSV file must contain columns: {required_columns} ({file})')
+
+    # 重複の削除
+    # NOTE: ファイル内のユーザーIDは一定のため、datetime だけで判定できる
+    df = df.drop_duplicates(subset=['datetime'], keep='last')
+
+    df['user_id'] = int(file.stem)
+    return df
 
 
 def load_consumption_data(consumption_dir: Path) -> pd.DataFrame:
@@ -65,75 +102,85 @@ def load_consumption_data(consumption_dir: Path) -> pd.DataFrame:
     if not all_files:
         raise Exception(f'No CSV files found in {consumption_dir}')
 
-    # 全てのCSVファイルをロード
-    all_dfs = []
-    for file in all_files:
-        user_id = file.stem
-        try:
-            int(user_id)
-        except ValueError:
-            raise ValueError(f'Invalid user_id in filename: {file}')
-
-        df = pd.read_csv(file)
-        df['user_id'] = int(user_id)
-        all_dfs.append(df)
-
-    combined_df = pd.concat(all_dfs, ignore_index=True)
+    # ファイル名 (ユーザーID) が数値かどうかを読み込み前にまとめてチェック
+    invalid_files = [file for file in all_files if not USER_ID_PATTERN.fullmatch(file.stem)]
+    if invalid_files:
+        raise ValueError(
+            f'Invalid user_id in filenames: {", ".join(str(file) for file in invalid_files[:5])}'
+        )
 
-    # 列名のチェック
-    required_columns = {'user_id', 'datetime', 'consumption'}
-    if not required_columns.issubset(combined_df.columns):
-        raise ValueError(f'CSV file must contain columns: {required_columns}')
+    # 全てのCSVファイルをロード
+    combined_df = pd.concat(
+        (read_consumption_csv(file) for file in all_files), ignore_index=True, copy=False
+    )
+    # ユーザーIDは同じ値が繰り返し現れるため、カテゴリ型にしてメモリを抑える
+    combined_df['user_id'] = combined_df['user_id'].astype('category')
 
     # datetimeのパース
     combined_df['datetime'] = pd.to_datetime(combined_df['datetime'])
-    # CSVデータにタイムゾーンの情報が含まれていない場合、UTCとして扱う
+    # CSVデータにタイムゾーンの情報が含まれていない場合、デフォルトのタイムゾーン (UTC) として扱う
+    # NOTE: make_aware を行ごとに apply せず、列全体をまとめてローカライズする
     if combined_df['datetime'].dt.tz is None:
-        combined_df['datetime'] = combined_df['datetime'].apply(make_aware)
+        combined_df['datetime'] = combined_df['datetime'].dt.tz_localize(
+            timezone.get_default_timezone()
+        )
+
+    # 重複はファイルごとに削除済み
+    # 異なるファイル名が同じユーザーID (例: 3000.csv と 03000.csv) を指す場合のみ、全体で重複を削除する
+    if combined_df['user_id'].nunique() < len(all_files):
+        combined_df = combined_df.drop_duplicates(subset=['user_id', 'datetime'], keep='last')
 
-    # 重複の削除
-    combined_df = combined_df.drop_duplicates(subset=['user_id', 'datetime'], keep='last')
-
-    # consumption が float か確認
-    if not is_float_dtype(combined_df['consumption']):
-        try:
-            combined_df['consumption'] = combined_df['consumption'].astype('float64')
-        except ValueError as e:
-            raise ValueError(
-                f'{e}. Correct the aforementioned characters in the consumption CSV to the appropriate numerical values.'
-            )
     return combined_df
 
 
-def make_consumption_data_list_to_create_and_update(
-    combined_df: pd.DataFrame,
-    existing_consumptions: dict[Any, Consumption],
-    existing_users: dict[int, User],
-) -> Iterable[list[Consumption]]:
-    """Consumption テーブルに登録する消費量のリストと、更新する消費量のリストを作成"""
-    consumption_data_to_create = []
-    consumption_data_to_update = []
-
-    for _, row in combined_df.iterrows():
-        user_id = row['user_id']
-        key = (user_id, row['datetime'])
-        if key in existing_consumptions:
-            consumption_data = existing_consumptions[key]
-            consumption_data.consumption = row['consumption']
-            consumption_data_to_update.append(consumption_data)
-        else:
-            consumption_data_to_create.append(
-                Consumption(
-                    user=existing_users[user_id],
-                    datetime=row['datetime'],
-                    consumption=row['consumption'],
-                )
-            )
+def copy_consumption_data(combined_df: pd.DataFrame) -> None:
+    """消費量を一時テーブルに COPY し、そこから Consumption テーブルへ一括で登録 (既存の場合は更新)
+
+    INSERT 文の代わりに PostgreSQL の COPY FROM STDIN で流し込むことで、行ごとの SQL のパースを省く.
+    一時テーブルはトランザクションの終了時に破棄されるため、トランザクション内で呼び出すこと.
+    """
+    # モデルからテーブル名を取得
+    consumption_table = Consumption._meta.db_table
+    staging_table = f'{consumption_table}_staging'
+
+    # NOTE: タイムゾーン付きの日時の文字列化は遅いため、UTC の naive な日時として書き出す
+    csv_df = combined_df[['user_id', 'datetime', 'consumption']].assign(
+        datetime=combined_df['datetime'].dt.tz_convert('UTC').dt.tz_localize(None)
+    )
 
-    return consumption_data_to_create, consumption_data_to_update
+    with io.StringIO() as buffer:
+        # NOTE: 空欄の消費量 (NaN) は空文字列のままだと COPY で NULL と解釈され NOT NULL 制約に反するため、
+        #       PostgreSQL が浮動小数点の NaN として読み込める 'NaN' と書き出す
+        csv_df.to_csv(buffer, header=False, index=False, na_rep='NaN')
+        buffer.seek(0)
+
+        with connection.cursor() as cursor:
+            # NOTE: 外側のトランザクション内で複数回呼び出された場合は、前回の一時テーブルが残っている
+            cursor.execute(f'DROP TABLE IF EXISTS {staging_table};')
+            cursor.execute(
+                f"""
+                CREATE TEMPORARY TABLE {staging_table} (
+                    user_id integer,
+                    datetime timestamp without time zone,
+                    consumption double precision
+                ) ON COMMIT DROP;
+                """
+            )
+            cursor.copy_expert(
+                f'COPY {staging_table} (user_id, datetime, consumption) FROM STDIN WITH CSV',
+                buffer,
+            )
+            # (user_id, datetime) が既存のレコードは consumption を上書きする
+            cursor.execute(
+                f"""
+                INSERT INTO {consumption_table} (user_id, datetime, consumption)
+                SELECT user_id, datetime AT TIME ZONE 'UTC', consumption FROM {staging_table}
+                ON CONFLICT (user_id, datetime) DO UPDATE SET consumption = EXCLUDED.consumption;
+                """
+            )
 
 
-def import_all_consumption_data(consumption_dir: Path, batch_size=1000):
+def import_all_consumption_data(consumption_dir: Path):
     """消費量の情報を複数の CSV から Consumption テーブルへインポート"""
     combined_df = load_consumption_data(consumption_dir)
 
@@ -146,36 +193,12 @@ def import_all_consumption_data(consumption_dir: Path, batch_size=1000):
         if int(user_id) not in existing_users:
             raise ValueError(f'User ID {user_id} not found in database')
 
-    # 既存の消費データを一括取得
-    existing_data = Consumption.objects.filter(
-        user_id__in=user_ids, datetime__in=combined_df['datetime'].tolist()
-    )
-    existing_consumptions = {(data.user.id, data.datetime): data for data in existing_data}
-
-    consumption_data_to_create, consumption_data_to_update = (
-        make_consumption_data_list_to_create_and_update(
-            combined_df=combined_df,
-            existing_consumptions=existing_consumptions,
-            existing_users=existing_users,
-        )
-    )
-
     with transaction.atomic():
-        for i in range(len(consumption_data_to_create) // batch_size + 1):
-            # IndexError が発生しないように処理をスキップ
-            if i * batch_size == len(consumption_data_to_create):
-                continue
-            Consumption.objects.bulk_create(
-                consumption_data_to_create[i * batch_size : (i + 1) * batch_size]
-            )
-
-        for i in range(len(consumption_data_to_update) // batch_size + 1):
-            # IndexError が発生しないように処理をスキップ
-            if i * batch_size == len(consumption_data_to_update):
-                continue
-            Consumption.objects.bulk_update(
-                consumption_data_to_update[i * batch_size : (i + 1) * batch_size], ['consumption']
-            )
+        copy_consumption_data(combined_df)
+        # 集計用の日ごとの合計を更新
+        refresh_daily_totals()
+        # 値のみの更新でも集計結果のキャッシュが破棄されるよう、データのバージョンを更新
+        bump_data_version()
 
 
 class Command(BaseCommand):
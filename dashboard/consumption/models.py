@@ -50,9 +50,40 @@ class Consumption(models.Model):
     consumption = models.FloatField(help_text='30分ごとのエネルギー消費量')
 
     class Meta:
+        # NOTE: (user, datetime) の複合インデックスはユニーク制約によって作成される
         constraints = [
             models.UniqueConstraint(fields=['user', 'datetime'], name='unique_user_datetime')
         ]
 
     def __str__(self):
         return f'User {self.user.id} - Datetime: {self.datetime} - Consumption: {self.consumption}'
+
+
+class DailyTotal(models.Model):
+    """Consumption をユーザーごと、日ごとに集計したテーブル (インポート時に更新)"""
+
+    id = models.AutoField(primary_key=True)
+    user = models.ForeignKey(
+        User, on_delete=models.PROTECT, help_text='この集計データに関連するユーザ'
+    )
+    date = models.DateField(help_text='集計した日付')
+    total = models.FloatField(help_text='日ごとのエネルギー消費量の合計')
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['user', 'date'], name='unique_user_date')]
+
+    def __str__(self):
+        return f'User {self.user.id} - Date: {self.date} - Total: {self.total}'
+
+
+class DataVersion(models.Model):
+    """集計結果のキャッシュのキーとするデータのバージョン (1行のみのテーブル)
+
+    インポートのたびに、インポートと同じトランザクション内で更新される
+    """
+
+    id = models.IntegerField(primary_key=True, help_text='常に 1')
+    imported_at = models.DateTimeField(help_text='最後にデータをインポートした日時')
+
+    def __str__(self):
+        return f'DataVersion - Imported at: {self.imported_at}'
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from consumption.cache import clear_user_ids
+from consumption.chart.statistics import bump_data_version
+from consumption.models import User
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_ids(sender, **kwargs):
+    """ユーザーが保存・削除されたら、ユーザーIDの一覧のキャッシュを破棄"""
+    clear_user_ids()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_statistics(sender, **kwargs):
+    """ユーザーが保存・削除されたら (admin でのエリアの変更など)、データのバージョンを更新
+
+    エリア別の集計結果とグラフのキャッシュが、古いエリアのまま返されないようにする.
+    NOTE: import コマンドの bulk_create / bulk_update ではシグナルが送られないため、
+          インポート側で明示的にバージョンを更新している
+    """
+    bump_data_version()
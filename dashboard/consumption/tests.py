@@ -1,26 +1,105 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import importlib
+import tempfile
+from pathlib import Path
+from unittest import mock
+
 import numpy as np
 import pandas as pd
-from django.test import TestCase
+from django.contrib import admin
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
 from django.utils import timezone
 
+from consumption.cache import USER_IDS_CACHE_KEY, get_user_ids
+from consumption.chart.generate import (
+    _generate_user_consumption_graph,
+    generate_user_consumption_graph,
+)
 from consumption.chart.statistics import (
+    bump_data_version,
     get_area_daily_percentiles,
     get_area_daily_total_consumptions,
+    get_area_daily_totals_and_percentiles,
     get_daily_percentiles_for_all,
     get_daily_total_consumptions_for_all,
+    get_data_version,
     get_user_area_daily_consumption_median,
     get_user_daily_total_consumptions,
+    refresh_daily_totals,
 )
-from consumption.models import Consumption, User
+from consumption.models import Consumption, DailyTotal, DataVersion, User
+
+# NOTE: コマンド名の import は予約語のため、importlib で読み込む
+import_command = importlib.import_module('consumption.management.commands.import')
+
+# 期待される日付の算出に用いるタイムゾーン (settings.TIME_ZONE)
+_TZ = timezone.get_default_timezone()
+
+
+def sum_consumption(df: pd.DataFrame, by: list[str]) -> pd.DataFrame:
+    """by ごとに消費量の合計を集計し、daily_total 列とする"""
+    return (
+        df.groupby(by, as_index=False)['consumption']
+        .sum()
+        .rename(columns={'consumption': 'daily_total'})
+    )
+
+
+def percentiles(user_daily_totals: pd.DataFrame, by: list[str]) -> pd.DataFrame:
+    """ユーザーごとの日ごとの消費量の合計から、by ごとに 10-90%-ile と中央値を集計"""
+    # by ごとにユーザーを列に並べた2次元配列にし、全グループの %-ile を1回の呼び出しで計算
+    # (データの無いユーザーは NaN となるため nanquantile を使う)
+    totals = user_daily_totals.pivot(index=by, columns='user_id', values='daily_total')
+    p10, p50, p90 = np.nanquantile(totals.to_numpy(), [0.1, 0.5, 0.9], axis=1)
+    return pd.DataFrame({'p10': p10, 'p50': p50, 'p90': p90}, index=totals.index).reset_index()
+
+
+def create_sample_data():
+    """グラフとビューのテスト用に、エリアの異なる2ユーザーの2日分の消費量を作成"""
+    User.objects.bulk_create(
+        [User(id=1, area='a1', tariff='t1'), User(id=2, area='a2', tariff='t2')]
+    )
+    datetimes = pd.date_range('2016-07-15', periods=2 * 48, freq='30min', tz=_TZ)
+    Consumption.objects.bulk_create(
+        [
+            Consumption(user_id=user_id, datetime=datetime, consumption=float(user_id))
+            for user_id in (1, 2)
+            for datetime in datetimes.to_pydatetime()
+        ]
+    )
+    refresh_daily_totals()
+    bump_data_version()
+
+
+def assert_df_close(actual: pd.DataFrame, expected: pd.DataFrame):
+    """列名・型・インデックスを確認した上で、列ごとに NumPy 配列として比較
+
+    数値の列は浮動小数点の誤差を許容し、それ以外の列 (エリア、日付) は完全一致とする
+    """
+    np.testing.assert_array_equal(actual.columns.to_numpy(), expected.columns.to_numpy())
+    np.testing.assert_array_equal(actual.dtypes.to_numpy(), expected.dtypes.to_numpy())
+    np.testing.assert_array_equal(actual.index.to_numpy(), expected.index.to_numpy())
+    for column in expected.columns:
+        actual_values = actual[column].to_numpy()
+        expected_values = expected[column].to_numpy()
+        if np.issubdtype(expected_values.dtype, np.number):
+            np.testing.assert_allclose(actual_values, expected_values, rtol=1e-10, err_msg=column)
+        else:
+            np.testing.assert_array_equal(actual_values, expected_values, err_msg=column)
 
 
 class StatisticsTests(TestCase):
-    def setUp(self):
+    @classmethod
+    def setUpTestData(cls):
+        # クラス内の全テストで共有するデータを1度だけ作成する
+        # (各テストの終了時にはトランザクションがロールバックされ、このデータに戻る)
+
         # ユーザーを作成
-        self.users = [
+        cls.users = [
             User.objects.create(id=1, area='a1', tariff='t1'),
             User.objects.create(id=2, area='a2', tariff='t3'),
             User.objects.create(id=3, area='a1', tariff='t1'),
@@ -30,190 +109,358 @@ class StatisticsTests(TestCase):
         # 基準時刻を作成
         std_time = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
 
-        # 消費データの値をまとめる配列
-        self.consumption_values = []
-
         # 3日分のデータを30分おきに作成
-        for day in range(3):
-            for half_hour in range(48):
-                datetime = (
-                    std_time
-                    - timezone.timedelta(days=day)
-                    + timezone.timedelta(minutes=30 * half_hour)
+        # 軸の順序は (日, 30分単位の時刻, ユーザー)
+        days = np.arange(3)
+        half_hours = np.arange(48)
+        user_indices = np.arange(len(cls.users))
+
+        datetimes = pd.Timestamp(std_time) + pd.to_timedelta(
+            (-days[:, None] * 24 * 60 + half_hours[None, :] * 30).ravel(), unit='min'
+        )
+        consumptions = np.broadcast_to(
+            10.0 * (user_indices[None, None, :] + 1) + half_hours[None, :, None],
+            (len(days), len(half_hours), len(user_indices)),
+        ).ravel()
+
+        # 期待されるデータフレームの作成用に、消費データを1つのデータフレームにまとめる
+        cls.consumption_df = pd.DataFrame(
+            {
+                'user_id': np.tile([user.id for user in cls.users], len(datetimes)),
+                'area': np.tile([user.area for user in cls.users], len(datetimes)),
+                'datetime': np.repeat(datetimes, len(cls.users)),
+                # ローカル日付への変換は全行ではなく、重複の無い時刻に対して1度だけ行う
+                'date': np.repeat(datetimes.tz_convert(_TZ).date, len(cls.users)),
+                'consumption': consumptions,
+            }
+        )
+
+        # 消費データを一括で作成
+        # 列ごとの配列から直接作成し、行ごとに User オブジェクトを引かない
+        Consumption.objects.bulk_create(
+            [
+                Consumption(user_id=user_id, datetime=datetime, consumption=consumption)
+                for user_id, datetime, consumption in zip(
+                    cls.consumption_df['user_id'].tolist(),
+                    cls.consumption_df['datetime'].tolist(),
+                    cls.consumption_df['consumption'].tolist(),
                 )
-                for i, user in enumerate(self.users):
-                    self.consumption_values.append((user, datetime, 10.0 * (i + 1) + half_hour))
+            ],
+            batch_size=1000,
+        )
 
-        # 消費データを作成
-        for user, datetime, consumption in self.consumption_values:
-            Consumption.objects.create(user=user, datetime=datetime, consumption=consumption)
+        # インポートと同様に、集計用の日ごとの合計を作成してデータのバージョンを更新
+        refresh_daily_totals()
+        bump_data_version()
+
+        # ユーザーごとの日ごとの消費量の合計
+        user_daily_totals = sum_consumption(cls.consumption_df, ['area', 'date', 'user_id'])
+
+        # 各関数の期待される結果を1度だけ作成し、全テストで共有する
+        area_daily_totals = sum_consumption(cls.consumption_df, ['area', 'date'])
+        area_daily_percentiles = percentiles(user_daily_totals, ['area', 'date'])
+
+        # 特定ユーザー (users[0]) とそのユーザーが属するエリアのデータ
+        user = cls.users[0]
+        user_consumption_df = cls.consumption_df[cls.consumption_df['user_id'] == user.id]
+        area_user_daily_totals = user_daily_totals[user_daily_totals['area'] == user.area]
+
+        cls.expected = {
+            # 日付ごとの合計
+            'daily_total_all': sum_consumption(cls.consumption_df, ['date']),
+            # 日付ごとのユーザーの日ごとの合計の %-ile
+            'percentiles_all': percentiles(user_daily_totals, ['date']),
+            # エリアごと、日付ごとの合計と %-ile
+            'area_daily_total': area_daily_totals,
+            'area_percentiles': area_daily_percentiles,
+            'area_total_and_percentiles': area_daily_totals.merge(
+                area_daily_percentiles, on=['area', 'date']
+            ),
+            # 特定ユーザーの日付ごとの合計
+            'user_daily_total': sum_consumption(user_consumption_df, ['date']),
+            # 特定ユーザーが属するエリアの、日付ごとのユーザーの日ごとの合計の中央値
+            'user_area_median': (
+                area_user_daily_totals.groupby('date')['daily_total']
+                .median()
+                .reset_index(name='p50')
+            ),
+        }
 
     def test_get_daily_total_consumptions_for_all(self):
         df = get_daily_total_consumptions_for_all()
-
-        # 消費データを日付ごとに集計
-        consumption_by_date = {}
-        for _, datetime, consumption in self.consumption_values:
-            date = datetime.astimezone(timezone.get_default_timezone()).date()
-            if date not in consumption_by_date:
-                consumption_by_date[date] = 0
-            consumption_by_date[date] += consumption
-
-        # 期待されるデータフレームを作成
-        expected_data = [
-            {'date': date, 'daily_total': total}
-            for date, total in sorted(consumption_by_date.items())
-        ]
-        expected_df = pd.DataFrame(expected_data)
-
-        # 期待されるデータフレームと関数の結果を比較
-        pd.testing.assert_frame_equal(df, expected_df)
+        assert_df_close(df, self.expected['daily_total_all'])
 
     def test_get_daily_percentiles_for_all(self):
         df = get_daily_percentiles_for_all()
-
-        # 日付ごとの消費データをユーザーごとに集計
-        consumption_by_date_user = {}
-        for user, datetime, consumption in self.consumption_values:
-            date = datetime.astimezone(timezone.get_default_timezone()).date()
-            if date not in consumption_by_date_user:
-                consumption_by_date_user[date] = {}
-            if user.id not in consumption_by_date_user[date]:
-                consumption_by_date_user[date][user.id] = 0
-            consumption_by_date_user[date][user.id] += consumption
-
-        # 期待されるデータフレームを作成
-        expected_data = []
-        for date, user_consumptions in consumption_by_date_user.items():
-            daily_totals = list(user_consumptions.values())
-            p10 = np.percentile(daily_totals, 10)
-            p50 = np.percentile(daily_totals, 50)
-            p90 = np.percentile(daily_totals, 90)
-            expected_data.append({'date': date, 'p10': p10, 'p50': p50, 'p90': p90})
-
-        expected_df = pd.DataFrame(expected_data).sort_values('date').reset_index(drop=True)
-        expected_df['date'] = pd.to_datetime(expected_df['date']).dt.tz_localize(
-            timezone.get_default_timezone()
-        )
-
-        # 期待されるデータフレームと関数の結果を比較
-        pd.testing.assert_frame_equal(df, expected_df)
+        assert_df_close(df, self.expected['percentiles_all'])
 
     def test_get_area_daily_total_consumptions(self):
         df = get_area_daily_total_consumptions()
-
-        # エリアごと、日付ごとの消費データを集計
-        consumption_by_area_date = {}
-        for user, datetime, consumption in self.consumption_values:
-            date = datetime.astimezone(timezone.get_default_timezone()).date()
-            area = user.area
-            if area not in consumption_by_area_date:
-                consumption_by_area_date[area] = {}
-            if date not in consumption_by_area_date[area]:
-                consumption_by_area_date[area][date] = 0
-            consumption_by_area_date[area][date] += consumption
-
-        # 期待されるデータフレームを作成
-        expected_data = []
-        for area, date_consumptions in consumption_by_area_date.items():
-            for date, total in date_consumptions.items():
-                expected_data.append({'area': area, 'date': date, 'daily_total': total})
-
-        expected_df = (
-            pd.DataFrame(expected_data).sort_values(['area', 'date']).reset_index(drop=True)
-        )
-
-        # 期待されるデータフレームと関数の結果を比較
-        pd.testing.assert_frame_equal(df, expected_df)
+        assert_df_close(df, self.expected['area_daily_total'])
 
     def test_get_area_daily_percentiles(self):
         df = get_area_daily_percentiles()
+        assert_df_close(df, self.expected['area_percentiles'])
+
+    def test_get_area_daily_totals_and_percentiles(self):
+        df = get_area_daily_totals_and_percentiles()
+        assert_df_close(df, self.expected['area_total_and_percentiles'])
+
+    def test_get_user_daily_total_consumptions(self):
+        df = get_user_daily_total_consumptions(self.users[0].id)
+        assert_df_close(df, self.expected['user_daily_total'])
+
+    def test_get_user_area_daily_consumption_median(self):
+        df = get_user_area_daily_consumption_median(self.users[0].id)
+        assert_df_close(df, self.expected['user_area_median'])
+
+
+class ImportConsumptionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.bulk_create(
+            [User(id=1, area='a1', tariff='t1'), User(id=2, area='a2', tariff='t2')]
+        )
 
-        # エリアごと、日付ごとの消費データをユーザーごとに集計
-        consumption_by_area_date_user = {}
-        for user, datetime, consumption in self.consumption_values:
-            date = datetime.astimezone(timezone.get_default_timezone()).date()
-            area = user.area
-            if area not in consumption_by_area_date_user:
-                consumption_by_area_date_user[area] = {}
-            if date not in consumption_by_area_date_user[area]:
-                consumption_by_area_date_user[area][date] = {}
-            if user.id not in consumption_by_area_date_user[area][date]:
-                consumption_by_area_date_user[area][date][user.id] = 0
-            consumption_by_area_date_user[area][date][user.id] += consumption
-
-        # 期待されるデータフレームを作成
-        expected_data = []
-        for area, date_consumptions in consumption_by_area_date_user.items():
-            for date, user_consumptions in date_consumptions.items():
-                daily_totals = list(user_consumptions.values())
-                p10 = np.percentile(daily_totals, 10)
-                p50 = np.percentile(daily_totals, 50)
-                p90 = np.percentile(daily_totals, 90)
-                expected_data.append(
-                    {'area': area, 'date': date, 'p10': p10, 'p50': p50, 'p90': p90}
+    def setUp(self):
+        # 消費量の CSV を置く一時ディレクトリ
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.consumption_dir = Path(tmp_dir.name)
+
+    def write_csv(self, filename: str, rows: list[tuple[str, float]]):
+        df = pd.DataFrame(rows, columns=['datetime', 'consumption'])
+        df.to_csv(self.consumption_dir / filename, index=False)
+
+    def assert_imported(self, consumptions: list[tuple], daily_totals: list[tuple]):
+        """Consumption と DailyTotal の内容が期待通りであることを確認"""
+        self.assertEqual(
+            list(
+                Consumption.objects.order_by('user_id', 'datetime').values_list(
+                    'user_id', 'datetime', 'consumption'
+                )
+            ),
+            [
+                (user_id, pd.Timestamp(datetime, tz=_TZ), consumption)
+                for user_id, datetime, consumption in consumptions
+            ],
+        )
+        self.assertEqual(
+            list(
+                DailyTotal.objects.order_by('user_id', 'date').values_list(
+                    'user_id', 'date', 'total'
                 )
+            ),
+            [(user_id, pd.Timestamp(date).date(), total) for user_id, date, total in daily_totals],
+        )
+
+    def test_reimport_updates_without_duplicates(self):
+        self.write_csv('1.csv', [('2016-07-15 00:00:00', 10.0), ('2016-07-15 00:30:00', 20.0)])
+        self.write_csv('2.csv', [('2016-07-15 00:00:00', 1.0)])
+        import_command.import_all_consumption_data(self.consumption_dir)
+        first_version = get_data_version()
+
+        self.assertIsNotNone(first_version)
+        self.assert_imported(
+            consumptions=[
+                (1, '2016-07-15 00:00:00', 10.0),
+                (1, '2016-07-15 00:30:00', 20.0),
+                (2, '2016-07-15 00:00:00', 1.0),
+            ],
+            daily_totals=[(1, '2016-07-15', 30.0), (2, '2016-07-15', 1.0)],
+        )
 
-        expected_df = (
-            pd.DataFrame(expected_data).sort_values(['area', 'date']).reset_index(drop=True)
+        # 2回目: 既存の値の修正、ファイル内の重複行 (後の行を採用)、新しい日付の追加
+        self.write_csv(
+            '1.csv',
+            [
+                ('2016-07-15 00:00:00', 10.0),
+                ('2016-07-15 00:30:00', 25.0),
+                ('2016-07-15 00:30:00', 30.0),
+                ('2016-07-16 00:00:00', 5.0),
+            ],
         )
-        expected_df['date'] = pd.to_datetime(expected_df['date']).dt.tz_localize(
-            timezone.get_default_timezone()
+        import_command.import_all_consumption_data(self.consumption_dir)
+
+        # 既存レコードの値のみの更新でも、データのバージョンは変わる
+        self.assertNotEqual(get_data_version(), first_version)
+        self.assert_imported(
+            consumptions=[
+                (1, '2016-07-15 00:00:00', 10.0),
+                (1, '2016-07-15 00:30:00', 30.0),
+                (1, '2016-07-16 00:00:00', 5.0),
+                (2, '2016-07-15 00:00:00', 1.0),
+            ],
+            daily_totals=[(1, '2016-07-15', 40.0), (1, '2016-07-16', 5.0), (2, '2016-07-15', 1.0)],
         )
 
-        # 期待されるデータフレームと関数の結果を比較
-        pd.testing.assert_frame_equal(df, expected_df)
+    @override_settings(TIME_ZONE='Asia/Tokyo')
+    def test_daily_totals_use_local_dates(self):
+        # 日本時間の 7/15 00:30 は UTC では 7/14 15:30 だが、日本時間の日付で集計される
+        self.write_csv('1.csv', [('2016-07-15 00:30:00', 10.0), ('2016-07-15 23:30:00', 20.0)])
+        import_command.import_all_consumption_data(self.consumption_dir)
 
-    def test_get_user_daily_total_consumptions(self):
-        user_id = self.users[0].id
-        df = get_user_daily_total_consumptions(user_id)
-
-        # 特定ユーザーの日付ごとの消費データを集計
-        consumption_by_date = {}
-        for user, datetime, consumption in self.consumption_values:
-            if user.id == user_id:
-                date = datetime.astimezone(timezone.get_default_timezone()).date()
-                if date not in consumption_by_date:
-                    consumption_by_date[date] = 0
-                consumption_by_date[date] += consumption
-
-        # 期待されるデータフレームを作成
-        expected_data = [
-            {'date': date, 'daily_total': total}
-            for date, total in sorted(consumption_by_date.items())
-        ]
-        expected_df = pd.DataFrame(expected_data)
+        self.assertEqual(
+            list(DailyTotal.objects.values_list('user_id', 'date', 'total')),
+            [(1, pd.Timestamp('2016-07-15').date(), 30.0)],
+        )
 
-        # 期待されるデータフレームと関数の結果を比較
-        pd.testing.assert_frame_equal(df, expected_df)
+    def test_blank_consumption_is_imported_as_nan(self):
+        self.write_csv('1.csv', [('2016-07-15 00:00:00', 10.0), ('2016-07-15 00:30:00', None)])
+        import_command.import_all_consumption_data(self.consumption_dir)
 
-    def test_get_user_area_daily_consumption_median(self):
-        user_id = self.users[0].id
-        df = get_user_area_daily_consumption_median(user_id)
-
-        # 特定ユーザーが属するエリアの日付ごとの消費データをユーザーごとに集計
-        user_area = self.users[0].area
-        consumption_by_date_user = {}
-        for user, datetime, consumption in self.consumption_values:
-            if user.area == user_area:
-                date = datetime.astimezone(timezone.get_default_timezone()).date()
-                if date not in consumption_by_date_user:
-                    consumption_by_date_user[date] = {}
-                if user.id not in consumption_by_date_user[date]:
-                    consumption_by_date_user[date][user.id] = 0
-                consumption_by_date_user[date][user.id] += consumption
-
-        # 期待されるデータフレームを作成
-        expected_data = []
-        for date, user_consumptions in consumption_by_date_user.items():
-            daily_totals = list(user_consumptions.values())
-            p50 = np.percentile(daily_totals, 50)
-            expected_data.append({'date': date, 'p50': p50})
-
-        expected_df = pd.DataFrame(expected_data).sort_values('date').reset_index(drop=True)
-        expected_df['date'] = pd.to_datetime(expected_df['date']).dt.tz_localize(
-            timezone.get_default_timezone()
+        consumptions = list(
+            Consumption.objects.order_by('datetime').values_list('consumption', flat=True)
         )
+        self.assertEqual(consumptions[0], 10.0)
+        self.assertTrue(np.isnan(consumptions[1]))
+        self.assertTrue(np.isnan(DailyTotal.objects.get(user_id=1).total))
+
+    def test_invalid_filename_raises_before_reading(self):
+        self.write_csv('1.csv', [('2016-07-15 00:00:00', 10.0)])
+        self.write_csv('user1.csv', [('2016-07-15 00:00:00', 10.0)])
+
+        with mock.patch.object(import_command, 'read_consumption_csv') as read_consumption_csv:
+            with self.assertRaisesMessage(ValueError, 'user1.csv'):
+                import_command.import_all_consumption_data(self.consumption_dir)
+
+        read_consumption_csv.assert_not_called()
+        self.assertFalse(Consumption.objects.exists())
+        self.assertIsNone(get_data_version())
+
+    def test_user_import_bumps_data_version(self):
+        bump_data_version()
+        version = get_data_version()
+
+        # 既存ユーザーのエリアのみを変更する
+        user_csv = self.consumption_dir / 'user_data.csv'
+        pd.DataFrame({'id': [1, 2], 'area': ['a2', 'a2'], 'tariff': ['t1', 't2']}).to_csv(
+            user_csv, index=False
+        )
+        import_command.import_user_data(user_csv)
+
+        self.assertEqual(User.objects.get(id=1).area, 'a2')
+        self.assertNotEqual(get_data_version(), version)
+
+
+class GraphTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_sample_data()
+
+    def test_user_graph_is_regenerated_after_area_change(self):
+        # データが変わらない間はキャッシュされたグラフを返す
+        graph = generate_user_consumption_graph(1)
+        hits = _generate_user_consumption_graph.cache_info().hits
+        self.assertEqual(generate_user_consumption_graph(1), graph)
+        self.assertEqual(_generate_user_consumption_graph.cache_info().hits, hits + 1)
+
+        # ユーザー情報のインポートでユーザー 1 のエリアを a2 に変更すると、エリアの中央値が変わる
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            user_csv = Path(tmp_dir) / 'user_data.csv'
+            pd.DataFrame({'id': [1, 2], 'area': ['a2', 'a2'], 'tariff': ['t1', 't2']}).to_csv(
+                user_csv, index=False
+            )
+            import_command.import_user_data(user_csv)
+
+        misses = _generate_user_consumption_graph.cache_info().misses
+        self.assertNotEqual(generate_user_consumption_graph(1), graph)
+        self.assertEqual(_generate_user_consumption_graph.cache_info().misses, misses + 1)
+
+
+class ViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_sample_data()
+
+    def test_graphs_are_served_as_png(self):
+        for url in [
+            reverse('total_graph'),
+            reverse('area_graph'),
+            reverse('user_graph', args=[1]),
+        ]:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Content-Type'], 'image/png')
+                self.assertTrue(response.content.startswith(b'\x89PNG'))
+
+    def test_unknown_user_returns_404(self):
+        # ETag はどのグラフでも同じデータのバージョンのため、他のグラフの ETag を送っても 404 となる
+        etag = self.client.get(reverse('total_graph'))['ETag']
+
+        for url in [reverse('detail', args=[999]), reverse('user_graph', args=[999])]:
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 404)
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 404)
+
+    def test_graph_with_matching_etag_returns_304(self):
+        url = reverse('total_graph')
+        etag = self.client.get(url)['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_graph_etag_changes_after_import(self):
+        url = reverse('total_graph')
+        etag = self.client.get(url)['ETag']
+
+        # 値のみの再インポートでもデータのバージョンが更新され、古い ETag では 304 にならない
+        bump_data_version()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class UserIdsCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        User.objects.create(id=1, area='a1', tariff='t1')
+
+    def test_user_ids_are_cached(self):
+        self.assertEqual(get_user_ids(), [1])
+        self.assertEqual(cache.get(USER_IDS_CACHE_KEY), [1])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_ids(), [1])
+
+    def test_saving_user_invalidates_cache(self):
+        get_user_ids()
+        User.objects.create(id=2, area='a2', tariff='t2')
+
+        self.assertIsNone(cache.get(USER_IDS_CACHE_KEY))
+        self.assertEqual(get_user_ids(), [1, 2])
+
+    def test_deleting_user_invalidates_cache(self):
+        get_user_ids()
+        User.objects.get(id=1).delete()
+
+        self.assertIsNone(cache.get(USER_IDS_CACHE_KEY))
+        self.assertEqual(get_user_ids(), [])
+
+
+class AdminTests(TestCase):
+    def test_derived_tables_are_not_registered(self):
+        self.assertNotIn(DailyTotal, admin.site._registry)
+        self.assertNotIn(DataVersion, admin.site._registry)
+
+    def test_consumption_admin_is_read_only(self):
+        request = RequestFactory().get('/admin/')
+        consumption_admin = admin.site._registry[Consumption]
+
+        self.assertFalse(consumption_admin.has_add_permission(request))
+        self.assertFalse(consumption_admin.has_change_permission(request))
+        self.assertFalse(consumption_admin.has_delete_permission(request))
+
+    def test_saving_user_bumps_data_version(self):
+        user = User.objects.create(id=1, area='a1', tariff='t1')
+        version = get_data_version()
+        self.assertIsNotNone(version)
 
-        # 期待されるデータフレームと関数の結果を比較
-        pd.testing.assert_frame_equal(df, expected_df)
+        # admin からエリアを変更した場合と同様に、save() でバージョンが更新される
+        user.area = 'a2'
+        user.save()
+        self.assertNotEqual(get_data_version(), version)
@@ -1,9 +1,12 @@
-from django.urls import re_path
+from django.urls import path
 
 from . import views
 
 urlpatterns = [
-    re_path(r'^$', views.summary),
-    re_path(r'^summary/', views.summary),
-    re_path(r'^detail/(?P<user_id>\d+)/$', views.detail, name='detail'),
+    path('', views.summary),
+    path('summary/', views.summary),
+    path('detail/<int:user_id>/', views.detail, name='detail'),
+    path('chart/total.png', views.total_graph, name='total_graph'),
+    path('chart/area.png', views.area_graph, name='area_graph'),
+    path('chart/user/<int:user_id>.png', views.user_graph, name='user_graph'),
 ]
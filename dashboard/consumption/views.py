@@ -1,29 +1,71 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.shortcuts import render
+from typing import Optional
 
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404, render
+from django.views.decorators.http import condition
+
+from consumption.cache import get_user_ids
 from consumption.chart.generate import (
     generate_daily_total_consumption_graph,
     generate_daily_total_consumption_graph_by_area,
     generate_user_consumption_graph,
 )
+from consumption.chart.statistics import get_data_version
 from consumption.models import User
 
 
 def summary(request):
-    graph = generate_daily_total_consumption_graph()
-    graph_by_area = generate_daily_total_consumption_graph_by_area()
-    user_ids = list(User.objects.values_list('id', flat=True).order_by('id'))
+    user_ids = get_user_ids()
 
-    context = {'graph': graph, 'graph_by_area': graph_by_area, 'user_ids': user_ids}
+    context = {'user_ids': user_ids}
     return render(request, 'consumption/summary.html', context)
 
 
 def detail(request, user_id: int):
-    user_ids = list(User.objects.values_list('id', flat=True).order_by('id'))
-    user_info = User.objects.get(id=user_id)
-    graph = generate_user_consumption_graph(user_id)
+    user_ids = get_user_ids()
+    user_info = get_object_or_404(User, id=user_id)
 
-    context = {'graph': graph, 'user_id': user_id, 'user_ids': user_ids, 'user_info': user_info}
+    context = {'user_id': user_id, 'user_ids': user_ids, 'user_info': user_info}
     return render(request, 'consumption/detail.html', context)
+
+
+def graph_etag(request, *args, **kwargs) -> Optional[str]:
+    """グラフの ETag として、グラフの生成元となるデータのバージョン (最後のインポート日時) を返す
+
+    データが変わらない限りブラウザには 304 を返し、PNG の生成と転送を省略する.
+    ユーザー情報・消費量のどちらをインポートしてもバージョンは更新されるため、
+    値のみやエリアのみの変更でも古いグラフは返さない.
+    一度もインポートしていない場合は ETag を付けない
+    """
+    version = get_data_version()
+    return version.isoformat() if version is not None else None
+
+
+def user_graph_etag(request, user_id: int) -> Optional[str]:
+    """ユーザーのグラフの ETag. 存在しないユーザーには ETag を付けず、304 ではなく 404 を返させる"""
+    if not User.objects.filter(id=user_id).exists():
+        return None
+    return graph_etag(request)
+
+
+# グラフは base64 でページに埋め込まず、PNG 画像として <img src> から取得させる
+@condition(etag_func=graph_etag)
+def total_graph(request):
+    graph = generate_daily_total_consumption_graph()
+    return HttpResponse(graph, content_type='image/png')
+
+
+@condition(etag_func=graph_etag)
+def area_graph(request):
+    graph = generate_daily_total_consumption_graph_by_area()
+    return HttpResponse(graph, content_type='image/png')
+
+
+@condition(etag_func=user_graph_etag)
+def user_graph(request, user_id: int):
+    user = get_object_or_404(User, id=user_id)
+    graph = generate_user_consumption_graph(user.id)
+    return HttpResponse(graph, content_type='image/png')